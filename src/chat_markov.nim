@@ -0,0 +1,149 @@
+import std / [tables, options, random, sequtils, sets, times, monotimes, algorithm]
+from std / strutils import splitWhitespace, join
+from std / unicode import toLower, runeLen
+import pkg / nimkov / [generator, objects, typedefs]
+
+const
+  MAX_CONTAINING_SEEDS = 5 # occurrences tried by generateContaining
+  MAX_BATCH_REPEATS = 5 # duplicates in a row before generateBatch gives up
+  BATCH_TIME_BUDGET = 250 # ms
+
+type
+  WordPosition = tuple[sample, word: int32]
+
+  ChatMarkov* = ref object
+    generator*: MarkovGenerator
+    index: Table[string, seq[WordPosition]] # (normalised word): positions in the samples
+    asLower: bool # the samples are learnt lowercase (not case sensitive sessions)
+
+  GenerateOptions = typeof(newMarkovGenerateOptions())
+
+
+proc normalise(word: string): string =
+  word.toLower()
+
+proc indexSample(self: ChatMarkov, sampleIdx: int, text: string) =
+  var position = 0'i32
+  for word in text.splitWhitespace():
+    self.index.mgetOrPut(word.normalise(), @[]).add((sampleIdx.int32, position))
+    inc position
+
+proc newChatMarkov*(samples: seq[string], asLower: bool = false): ChatMarkov =
+  result = ChatMarkov(generator: newMarkov(samples, asLower = asLower), asLower: asLower)
+  for i, sample in samples:
+    result.indexSample(i, sample)
+
+proc addSample*(self: ChatMarkov, sample: string, asLower: bool = false) =
+  self.generator.addSample(sample, asLower = asLower)
+  self.asLower = asLower
+  self.indexSample(self.generator.samples.high, sample)
+
+template samples*(self: ChatMarkov): seq[string] =
+  self.generator.samples
+
+proc generate*(self: ChatMarkov): Option[string] =
+  self.generator.generate()
+
+proc generate*(self: ChatMarkov, options: GenerateOptions): Option[string] =
+  self.generator.generate(options = options)
+
+proc knows*(self: ChatMarkov, word: string): bool =
+  word.normalise() in self.index
+
+proc generateStartingWith*(self: ChatMarkov, start: string): Option[string] =
+  # Fails fast, without walking the chain, when
+  # a word of `start` never appeared in this chat
+  let words = start.splitWhitespace()
+  if words.len == 0 or not words.allIt(self.knows(it)):
+    return none(string)
+
+  try:
+    return self.generator.generate(options = newMarkovGenerateOptions(begin = some start))
+  except MarkovGenerateError:
+    return none(string)
+
+proc generateContaining*(self: ChatMarkov, word: string): Option[string] =
+  # Seeds the chain from the word that follows `word` in a sample where it
+  # occurs, keeping the words up to `word` from that sample. Starting from
+  # `word` itself would only repeat the walk generateStartingWith failed
+  let key = word.normalise()
+  if key notin self.index:
+    return none(string)
+
+  let positions = self.index[key]
+  var tried: HashSet[string]
+  for _ in 0 ..< min(positions.len, MAX_CONTAINING_SEEDS):
+    let (sampleIdx, position) = positions.sample()
+    if sampleIdx > self.generator.samples.high:
+      continue
+
+    let words = self.generator.samples[sampleIdx].splitWhitespace()
+    if position >= words.high or words[position].normalise() != key:
+      # `word` is the last word of the sample: nothing to continue from
+      continue
+
+    # the chain of a case insensitive session only knows lowercase words
+    let
+      prefix = if self.asLower: words[0 .. position].mapIt(it.toLower()) else: words[0 .. position]
+      next = if self.asLower: words[position + 1].toLower() else: words[position + 1]
+    if next.normalise() == key or tried.containsOrIncl(next):
+      continue
+
+    try:
+      let generated = self.generator.generate(options = newMarkovGenerateOptions(begin = some next))
+      if generated.isSome:
+        return some((prefix & generated.get()).join(" "))
+    except MarkovGenerateError:
+      discard
+
+  return none(string)
+
+proc generateBatch*(self: ChatMarkov, count: int, maxLength: int = 0, minWords: int = 1, timeBudget: int = BATCH_TIME_BUDGET): seq[string] =
+  # Up to `count` distinct sentences of at least `minWords` words. On small
+  # corpora the chain keeps producing the same sentences: stop after a few
+  # duplicates in a row, or when `timeBudget` (ms) runs out. Sentences longer
+  # than `maxLength` runes (0: no limit) are only used to fill the remaining slots
+  let deadline = getMonoTime() + initDuration(milliseconds = timeBudget)
+  var
+    seen: HashSet[string]
+    overlong: seq[string]
+    repeats = 0
+
+  while result.len < count and repeats < MAX_BATCH_REPEATS and getMonoTime() < deadline:
+    var generated: Option[string]
+    try:
+      generated = self.generator.generate()
+    except MarkovGenerateError:
+      break
+    if generated.isNone:
+      break
+
+    let text = generated.get()
+    if seen.containsOrIncl(text):
+      inc repeats
+      continue
+    repeats = 0
+
+    if text.splitWhitespace().len < minWords:
+      continue
+    if maxLength > 0 and text.runeLen > maxLength:
+      overlong.add(text)
+    else:
+      result.add(text)
+
+  for text in overlong:
+    if result.len >= count:
+      break
+    result.add(text)
+
+proc generateBest*(self: ChatMarkov, candidates: int, maxLength: int, minWords: int = 1): Option[string] =
+  # The longest of a few candidates that fits in `maxLength` runes,
+  # or the shortest one if none fits
+  let batch = self.generateBatch(candidates, maxLength = maxLength, minWords = minWords)
+  if batch.len == 0:
+    return none(string)
+
+  let fitting = batch.filterIt(it.runeLen <= maxLength)
+  if fitting.len > 0:
+    return some(fitting.sortedByIt(-it.runeLen)[0])
+  return some(batch.sortedByIt(it.runeLen)[0])
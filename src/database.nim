@@ -54,10 +54,13 @@ template inTransaction(conn: DbConn, query: string) =
     discard conn.tryExec(sql(query))
 
 
-const DATA_FOLDER* = "data"
+const
+  DATA_FOLDER* = "data"
+  BUSY_TIMEOUT = 5000 # ms, writes wait for the readers (e.g. tools/backup.py) instead of failing
 
-proc initDatabase*(name: string = "markov.db"): DbConn =
-  result = open(DATA_FOLDER / name, "", "", "")
+proc initDatabase*(path: string = DATA_FOLDER / "markov.db"): DbConn =
+  result = open(path, "", "", "")
+  discard result.getValue(int64, sql("PRAGMA busy_timeout = " & $BUSY_TIMEOUT))
   result.createTables(User())
   result.createTables(Chat())
   result.createTables(Session(chat: Chat()))
@@ -251,6 +254,25 @@ proc deleteAllMessagesFromUser*(conn: DbConn, userId: int64): int64 {.gcsafe.} =
   conn.exec(sql query, params)
   return count
 
+proc getRecentlyActiveChats*(conn: DbConn, window: int64, limit: int): seq[int64] {.gcsafe.} =
+  # Chats with messages among the latest `window` ones, most recently active first.
+  # Only a range of the messages primary key is scanned
+  let query = """
+    SELECT chats.chatId FROM messages
+    JOIN sessions ON sessions.id = messages.session
+    JOIN chats ON chats.id = sessions.chat
+    WHERE messages.id > (SELECT COALESCE(MAX(id), 0) FROM messages) - ?
+      AND sessions.isDefault AND chats.enabled AND NOT chats.banned
+    GROUP BY chats.chatId
+    ORDER BY MAX(messages.id) DESC
+    LIMIT ?"""
+  let params = @[
+    DbValue(kind: dvkInt, i: window),
+    DbValue(kind: dvkInt, i: int64(limit)),
+  ]
+  for row in conn.getAllRows(sql query, params):
+    result.add(row[0].i)
+
 proc getBotAdmins*(conn: DbConn): seq[User] {.gcsafe.} =
   result = @[User()]
   conn.select(result, "admin")
@@ -1,10 +1,10 @@
 import std/[asyncdispatch, logging, options, os, times, strutils, strformat, tables, random, sets, parsecfg, sequtils, streams, sugar, re, algorithm]
-from std / unicode import runeOffset
+from std / unicode import runeOffset, runeLen
 import pkg / norm / [model, sqlite]
 import pkg / [telebot, owoifynim, emojipasta]
 import pkg / nimkov / [generator, objects, typedefs, constants]
 
-import database
+import database, chat_markov
 import utils / [unixtime, timeout, listen, as_emoji, get_owoify_level, human_bytes, random_emoji]
 import quotes / quote
 
@@ -14,11 +14,13 @@ var
   conn {.threadvar.}: DbConn
   admins {.threadvar.}: HashSet[int64]
   banned {.threadvar.}: HashSet[int64]
-  markovs {.threadvar.}: Table[int64, (int64, MarkovGenerator)] # (chatId): (timestamp, MarkovChain)
+  markovs {.threadvar.}: Table[int64, (int64, ChatMarkov)] # (chatId): (timestamp, MarkovChain)
   adminsCache {.threadvar.}: Table[(int64, int64), (int64, bool)] # (chatId, userId): (unixtime, isAdmin) cache
   chatSessions {.threadvar.}: Table[int64, (int64, Session)] # (chatId): (unixtime, Session) cache
   antiFlood {.threadvar.}: Table[int64, seq[int64]]
   keepLast: int = 1500
+  warmupChats: int = 50
+  markovDb: string
   quoteConfig {.threadvar.}: QuoteConfig
 
 let uptime = epochTime()
@@ -34,6 +36,16 @@ const
   GROUP_ADMINS_CACHE_TIMEOUT = 60 * 5 # result is valid for five minutes
   MARKOV_CHAT_SESSIONS_TIMEOUT = 60 * 30 # 30 minutes
 
+  WARMUP_MESSAGES_WINDOW = 50_000 # latest messages looked at to find the active chats
+  WARMUP_MIN_PAUSE = 10 # ms
+  WARMUP_CACHE_TIMEOUT = 60 * 60 * 24 # a prefilled chat stays cached up to a day, waiting for its first use
+
+  POLL_CANDIDATES = 10
+  POLL_OPTION_LENGTH = 100 # Telegram's limit
+  QUOTE_CANDIDATES = 5
+  QUOTE_MAX_LENGTH = 150 # runes that fit in the picture at a readable size
+  QUOTE_MIN_WORDS = 3
+
   MAX_SESSIONS = 20
   MAX_FREE_SESSIONS = 5
   MAX_SESSION_NAME_LENGTH = 16
@@ -57,7 +69,9 @@ let
   UrlRegex = re(r"""(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))""", flags = {reIgnoreCase, reStudy})
   UsernameRegex = re("@([a-zA-Z](_(?!_)|[a-zA-Z0-9]){3,32}[a-zA-Z0-9])", flags = {reIgnoreCase, reStudy})
 
-template get(self: Table[int64, (int64, MarkovGenerator)], chatId: int64): MarkovGenerator =
+template get(self: Table[int64, (int64, ChatMarkov)], chatId: int64): ChatMarkov =
+  # each use keeps the chain cached for another MARKOV_SAMPLES_CACHE_TIMEOUT
+  self[chatId][0] = unixTime()
   self[chatId][1]
 
 proc echoError(args: varargs[string]) =
@@ -144,6 +158,40 @@ proc cleanerWorker {.async.} =
 
     await sleepAsync(30)
 
+proc warmupWorker {.async.} =
+  # Prefills the sessions and markov chains of the recently active chats
+  # after a restart, while the bot is already serving updates. One chat at
+  # a time, pausing as long as each refill took, to leave half the CPU to
+  # the updates
+  let chats = conn.getRecentlyActiveChats(window = WARMUP_MESSAGES_WINDOW, limit = warmupChats)
+  var warmed = 0
+
+  for chatId in chats:
+    await sleepAsync(WARMUP_MIN_PAUSE)
+    if markovs.hasKey(chatId):
+      continue
+
+    let start = epochTime()
+    try:
+      let session = conn.getCachedSession(chatId)
+      markovs[chatId] = (unixTime(), newChatMarkov(@[]))
+      conn.refillMarkov(session)
+
+      # timestamps in the future: the cleaner keeps them until the first
+      # use (which resets the chain's one) or WARMUP_CACHE_TIMEOUT
+      let time = unixTime()
+      markovs[chatId][0] = time + WARMUP_CACHE_TIMEOUT - MARKOV_SAMPLES_CACHE_TIMEOUT
+      chatSessions[chatId][0] = time + WARMUP_CACHE_TIMEOUT - MARKOV_CHAT_SESSIONS_TIMEOUT
+      inc warmed
+    except CatchableError as error:
+      # don't leave an empty or partial chain in the cache
+      markovs.del(chatId)
+      echoError &"[ERROR] | Warm start of {chatId} failed: " & $error.name & ": " & error.msg & ";"
+
+    await sleepAsync(toInt((epochTime() - start) * 1000))
+
+  echoError &"Warm start completed: {warmed} chats prefilled"
+
 proc isAdminInGroup(bot: Telebot, chatId: int64, userId: int64): Future[bool] {.async.} =
   let time = unixTime()
   if (chatId, userId) in adminsCache:
@@ -165,7 +213,6 @@ proc handler() {.noconv.} =
 setControlCHook(handler)
 
 
-proc byLength(a, b: string): int = cmp(len(a), len(b))
 proc trimUnicode(s: string, length: int): string =
   let offset = s.runeOffset(length)
   if offset == -1:
@@ -178,7 +225,10 @@ proc sortCandidates(options: seq[string], length: int): seq[string] =
   #   minLength = min(lengths)
   #   maxLength = max(lengths)
 
-  options.sort(byLength)
+  # longest first, but the candidates that fit in `length`
+  # come before the ones that would have to be trimmed
+  options.sort(proc (a, b: string): int =
+    cmp((a.runeLen <= length, len(a)), (b.runeLen <= length, len(b))))
   options.reverse()
 
   for i in 0 ..< options.len:
@@ -389,7 +439,7 @@ proc handleCommand(bot: Telebot, update: Update, command: string, args: seq[stri
       &"*Cached sessions*: `{len(chatSessions)}`\n" &
       &"*Cached markovs*: `{len(markovs)}`\n" &
       &"*Uptime*: `{toInt(epochTime() - uptime)}`s\n" &
-      &"*Database size*: `{humanBytes(getFileSize(DATA_FOLDER / MARKOV_DB))}`\n" &
+      &"*Database size*: `{humanBytes(getFileSize(markovDb))}`\n" &
       &"*Memory usage (getOccupiedMem)*: `{humanBytes(getOccupiedMem())}`\n" &
       &"*Memory usage (getTotalMem)*: `{humanBytes(getTotalMem())}`\n"
 
@@ -542,7 +592,7 @@ proc handleCommand(bot: Telebot, update: Update, command: string, args: seq[stri
         return
     
     if not markovs.hasKey(message.chat.id):
-      markovs[message.chat.id] = (unixTime(), newMarkov(@[]))
+      markovs[message.chat.id] = (unixTime(), newChatMarkov(@[]))
       conn.refillMarkov(cachedSession)
 
     if len(markovs.get(message.chat.id).samples) == 0:
@@ -553,17 +603,26 @@ proc handleCommand(bot: Telebot, update: Update, command: string, args: seq[stri
     if not cachedSession.caseSensitive:
       start = start.toLower()
 
-    let options = if len(args) > 0 and (args[0] != mrkvEnd or len(args) >= 2):
-        newMarkovGenerateOptions(begin = some start)
-      else:
-        newMarkovGenerateOptions()
-
+    let withWords = len(args) > 0 and (args[0] != mrkvEnd or len(args) >= 2)
     {.cast(gcsafe).}:
       let generator = markovs.get(message.chat.id)
-      let generated = try:
-          generator.generate(options = options)
-        except MarkovGenerateError:
-          generator.generate()
+      var generated = none(string)
+      if withWords:
+        # the word index lets unknown words fail fast, without walking the chain
+        generated = generator.generateStartingWith(start)
+        if generated.isNone and len(args) == 1:
+          generated = generator.generateContaining(start)
+      else:
+        if command == "quote":
+          # pick the candidate that looks best in the picture
+          generated = generator.generateBest(QUOTE_CANDIDATES, maxLength = QUOTE_MAX_LENGTH, minWords = QUOTE_MIN_WORDS)
+        if generated.isNone:
+          generated = generator.generate()
+
+    if generated.isNone and withWords:
+      # rather than an unrelated sentence
+      discard await bot.sendMessage(message.chat.id, "I couldn't generate a sentence with that in this chat", messageThreadId=threadId)
+      return
 
     if generated.isSome:
       var text = generated.get()
@@ -616,7 +675,7 @@ proc handleCommand(bot: Telebot, update: Update, command: string, args: seq[stri
         return
     
     if not markovs.hasKey(message.chat.id):
-      markovs[message.chat.id] = (unixTime(), newMarkov(@[]))
+      markovs[message.chat.id] = (unixTime(), newChatMarkov(@[]))
       conn.refillMarkov(cachedSession)
 
     if len(markovs.get(message.chat.id).samples) < 10:
@@ -624,24 +683,19 @@ proc handleCommand(bot: Telebot, update: Update, command: string, args: seq[stri
       return
 
     let generator = markovs.get(message.chat.id)
-    var options: seq[string]
-    for i in 0 ..< 10:
-      {.cast(gcsafe).}:
-        let generated = generator.generate()
-      if generated.isSome:
-        var text = generated.get()
-        if cachedSession.owoify != 0:
-          {.cast(gcsafe).}:
-            text = text.owoify(getOwoifyLevel(cachedSession.owoify))
-        if cachedSession.emojipasta:
-          {.cast(gcsafe).}:
-            text = emojify(text)
-        options.add(text)
-      else:
-        break
+    {.cast(gcsafe).}:
+      var options = generator.generateBatch(POLL_CANDIDATES, maxLength = POLL_OPTION_LENGTH)
+    for text in options.mitems:
+      if cachedSession.owoify != 0:
+        {.cast(gcsafe).}:
+          text = text.owoify(getOwoifyLevel(cachedSession.owoify))
+      if cachedSession.emojipasta:
+        {.cast(gcsafe).}:
+          text = emojify(text)
 
+    # owoify and emojipasta can make two options equal, or longer than the limit
     options = options.deduplicate(isSorted = false)
-    options = options.sortCandidates(length = 100)
+    options = options.sortCandidates(length = POLL_OPTION_LENGTH)
 
     if len(options) < 2:
       discard await bot.sendMessage(message.chat.id, "Not enough data to generate a would you rather poll", messageThreadId=threadId)
@@ -853,7 +907,7 @@ proc handleCallbackQuery(bot: Telebot, update: Update) {.async, gcsafe.} =
 
         chatSessions[chatId] = (unixTime(), newSession[0])
 
-        markovs[chatId] = (unixTime(), newMarkov(
+        markovs[chatId] = (unixTime(), newChatMarkov(
           conn.getLatestMessages(session = newSession[0], count = keepLast)
           .filterIt(newSession[0].isMessageOk(it.text))
           .mapIt(it.text), asLower = not newSession[0].caseSensitive)
@@ -1090,7 +1144,7 @@ proc updateHandler(bot: Telebot, update: Update): Future[bool] {.async, gcsafe.}
 
       if not cachedSession.isMessageOk(text):
         return
-      elif not markovs.hasKeyOrPut(chatId, (unixTime(), newMarkov((if user.consented and not cachedSession.learningPaused: @[text] else: @[]), asLower = not cachedSession.caseSensitive))):
+      elif not markovs.hasKeyOrPut(chatId, (unixTime(), newChatMarkov((if user.consented and not cachedSession.learningPaused: @[text] else: @[]), asLower = not cachedSession.caseSensitive))):
         conn.refillMarkov(cachedSession)
       else:
         if user.consented and not cachedSession.learningPaused:
@@ -1120,8 +1174,15 @@ proc updateHandler(bot: Telebot, update: Update): Future[bool] {.async, gcsafe.}
       if (rand(1 .. 100) <= percentage or (percentage > 0 and repliedToMarkinim and cachedSession.alwaysReply)) and not isFlood(chatId, rate = 10, seconds = 30):
         # Max 10 messages per chat per 30 seconds
 
+        # Randomly send a quote: roll first, so that only quotes pay for the extra candidates
+        let sendQuote = not cachedSession.chat.quotesDisabled and rand(0 .. 30) == 20
+
         {.cast(gcsafe).}:
-          let generated = markovs.get(chatId).generate()
+          var generated = none(string)
+          if sendQuote:
+            generated = markovs.get(chatId).generateBest(QUOTE_CANDIDATES, maxLength = QUOTE_MAX_LENGTH, minWords = QUOTE_MIN_WORDS)
+          if generated.isNone:
+            generated = markovs.get(chatId).generate()
         if generated.isSome:
           var text = generated.get()
           if cachedSession.owoify != 0:
@@ -1131,8 +1192,7 @@ proc updateHandler(bot: Telebot, update: Update): Future[bool] {.async, gcsafe.}
             {.cast(gcsafe).}:
               text = emojify(text)
 
-          if not cachedSession.chat.quotesDisabled and rand(0 .. 30) == 20:
-            # Randomly send a quote
+          if sendQuote:
             {.cast(gcsafe).}:
               let quotePic = genQuote(
                 text = text,
@@ -1168,14 +1228,17 @@ proc main {.async.} =
     botToken = config.getSectionValue("config", "token", getEnv("BOT_TOKEN"))
     admin = config.getSectionValue("config", "admin", getEnv("ADMIN_ID"))
     loggingEnabled = config.getSectionValue("config", "logging", getEnv("LOGGING")).strip() == "1"
+    apiUrl = config.getSectionValue("config", "apiurl", getEnv("BOT_API_URL", "https://api.telegram.org"))
 
   if botToken == "":
     echoError "[ERROR]: Token not provided. Check secret.ini or environment variables"
     quit(1)
 
   keepLast = parseInt(config.getSectionValue("config", "keeplast", getEnv("KEEP_LAST", $keepLast)))
+  warmupChats = parseInt(config.getSectionValue("config", "warmupchats", getEnv("WARMUP_CHATS", $warmupChats)))
+  markovDb = config.getSectionValue("config", "database", getEnv("MARKOV_DB", DATA_FOLDER / MARKOV_DB))
 
-  conn = initDatabase(MARKOV_DB)
+  conn = initDatabase(markovDb)
   defer: conn.close()
 
   quoteConfig = getQuoteConfig()
@@ -1189,7 +1252,7 @@ proc main {.async.} =
   for bannedUser in conn.getBannedUsers():
     banned.incl(bannedUser.userId)
 
-  let bot = newTeleBot(botToken)
+  let bot = newTeleBot(botToken, serverUrl = apiUrl)
   bot.username = (await bot.getMe()).username.get().strip()
   echoError "Running... Bot username: ", bot.username
 
@@ -1199,6 +1262,8 @@ proc main {.async.} =
     echoError "Warning: logging is not enabled. Enable it with [LOGGING=1 in .env] or [logging = 1 in secret.ini] if needed"
 
   asyncCheck cleanerWorker()
+  if warmupChats > 0:
+    asyncCheck warmupWorker()
   bot.onUpdate(updateHandler)
   discard await bot.getUpdates(offset = -1)
 
@@ -0,0 +1,301 @@
+# python3 tools/backup.py [--output-file=/path/to/markov_backup.db] [--markovdb=/path/to/markov.db] [--pages=256] [--throttle=0.05] [--attempts=3] [--profile]
+# python3 tools/backup.py --incremental [--output-file=/path/to/markov_backup.db] [--markovdb=/path/to/markov.db] [--batch-size=5000] [--profile]
+
+# Hot backup of the markov database. It can run while the bot is live:
+# - full backups use the SQLite online backup API, copying a few pages
+#   per step and sleeping between steps, so the bot can keep writing.
+#   Every write of the bot restarts the copy: after a few restarts the
+#   attempt is abandoned and retried later, up to --attempts times;
+# - incremental backups update a copy of an existing backup, copying the
+#   messages newer than the last backed up one and mirroring the older
+#   ones that were deleted or changed (including reused ids).
+# Every backup is verified with PRAGMA integrity_check, and replaces the
+# previous one only if it passes.
+#
+# NOTE: incremental backups are not a point-in-time snapshot: they read
+# the live database in many short transactions, not to block the bot. The
+# users, chats and sessions are mirrored last, so every backed up message
+# has its session, but the backup may have sessions (or a few messages)
+# that changed while it was running. Full backups are consistent.
+
+import shutil
+import sqlite3
+import time
+import traceback
+from pathlib import Path
+
+from rich.progress import Progress
+
+from common import ROOT, connect, console, database_uri, id_ranges, new_parser, parse_args, profiler, transaction
+
+parser = new_parser("Back up the database while the bot is running")
+parser.add_argument(
+    "--output-file",
+    type=Path,
+    default=ROOT / "backup" / "markov_backup.db",
+    help="The backup database to write (or to update, with --incremental)",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Only copy the changes since the last backup (falls back to a full backup if there is none)",
+)
+parser.add_argument(
+    "--pages",
+    type=int,
+    default=256,
+    help="Pages copied per backup step (full backups only)",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=5000,
+    help="Message ids copied or compared per transaction (incremental backups only)",
+)
+parser.add_argument(
+    "--throttle",
+    type=float,
+    default=0.05,
+    help="Seconds to sleep between steps, to leave room for the bot",
+)
+parser.add_argument(
+    "--max-restarts",
+    type=int,
+    default=3,
+    help="Restarts of a full backup (caused by the bot writing) before giving up on an attempt",
+)
+parser.add_argument(
+    "--attempts",
+    type=int,
+    default=3,
+    help="Full backup attempts before failing",
+)
+parser.add_argument(
+    "--retry-pause",
+    type=float,
+    default=30,
+    help="Seconds to wait between full backup attempts",
+)
+args = parse_args(parser)
+
+output_file: Path = args.output_file
+markovdb: Path = args.markovdb
+throttle: float = args.throttle
+
+if not output_file.parent.is_dir():
+    console.print(f"[red]Directory not found: {output_file.parent}[/red]")
+    exit(1)
+
+# The small tables are mirrored entirely at every incremental backup
+SMALL_TABLES = ("users", "chats", "sessions")
+
+
+def integrity_check(path: Path) -> bool:
+    with console.status(f"[bold green]Verifying {path.name}..."), profiler.phase("Verify"):
+        with connect(path, readonly=True) as conn:
+            result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+
+    if result != ["ok"]:
+        console.print(f"[red]Integrity check failed for {path}:[/red]")
+        for line in result[:20]:
+            console.print(f"[red]  {line}[/red]")
+        return False
+
+    console.print("[bold green]Integrity check passed[/bold green]")
+    return True
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def copy_pages(tmp_file: Path) -> bool:
+    # False if the bot kept writing, and the copy restarted too many times
+    restarts = 0
+    last_remaining: int | None = None
+
+    with Progress() as progress:
+        task = progress.add_task("Copying pages", total=None)
+
+        def on_step(status: int, remaining: int, total: int) -> None:
+            nonlocal restarts, last_remaining
+            # a write to the source restarts the copy from the first page
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts >= args.max_restarts:
+                    raise BackupRestarted
+            last_remaining = remaining
+
+            progress.update(task, total=total, completed=total - remaining)
+            if remaining:
+                # the source is unlocked between steps, let the bot write
+                time.sleep(throttle)
+
+        tmp_file.unlink(missing_ok=True)
+        # read-only, the backup must never write to the live database
+        live = connect(markovdb, readonly=True)
+        # a new file: the shared connect() only opens existing databases
+        target = sqlite3.connect(tmp_file)
+        try:
+            live.backup(target, pages=args.pages, progress=on_step)
+        except BackupRestarted:
+            return False
+        finally:
+            target.close()
+            live.close()
+    return True
+
+
+def full_backup() -> None:
+    # write to a temporary file first, so a failed backup
+    # never replaces the previous (good) one
+    tmp_file = output_file.with_name(output_file.name + ".tmp")
+
+    # Copying everything in one step would hold the read lock for the whole
+    # copy, failing the writes of the bot meanwhile: retry a few times
+    # instead, hoping for a quieter moment
+    with profiler.phase("Copy pages"):
+        for attempt in range(1, args.attempts + 1):
+            if copy_pages(tmp_file):
+                break
+            console.print(
+                f"[yellow]Attempt {attempt}/{args.attempts}: the copy restarted {args.max_restarts} times while the bot was writing[/yellow]"
+            )
+            if attempt < args.attempts:
+                time.sleep(args.retry_pause)
+        else:
+            tmp_file.unlink(missing_ok=True)
+            console.print(
+                "[red]The bot kept writing during the copy: try again later, or with more --pages per step[/red]"
+            )
+            exit(1)
+
+    if not integrity_check(tmp_file):
+        tmp_file.unlink(missing_ok=True)
+        exit(1)
+
+    tmp_file.replace(output_file)
+    console.print(f"[bold green]Full backup written to {output_file}[/bold green]")
+
+
+def columns(conn: sqlite3.Connection, schema: str, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA "{schema}".table_info("{table}")')]
+
+
+def incremental_backup() -> None:
+    # update a copy, so a failed update never leaves
+    # the previous (good) backup half updated
+    tmp_file = output_file.with_name(output_file.name + ".tmp")
+    with console.status(f"[bold green]Copying {output_file.name}..."), profiler.phase("Copy previous backup"):
+        shutil.copyfile(output_file, tmp_file)
+
+    conn = connect(tmp_file, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS live", (database_uri(markovdb, "ro"),))
+
+        for table in SMALL_TABLES + ("messages",):
+            if columns(conn, "main", table) != columns(conn, "live", table):
+                console.print(
+                    f"[red]The schema of '{table}' changed since the last backup: run a full backup[/red]"
+                )
+                exit(1)
+
+        checkpoint = conn.execute("SELECT COALESCE(MAX(id), 0) FROM main.messages").fetchone()[0]
+        console.print(f"[bold green]Last backed up message id: {checkpoint}[/bold green]")
+
+        cols = ", ".join(f'"{col}"' for col in columns(conn, "live", "messages"))
+        live_max = conn.execute("SELECT COALESCE(MAX(id), 0) FROM live.messages").fetchone()[0]
+        total_deleted = 0
+        total_recopied = 0
+        total_copied = 0
+
+        # ids aren't AUTOINCREMENT: once the newest messages are deleted
+        # (cleaner, /delete, GDPR requests), the bot reuses their ids, so
+        # the backed up rows are compared entirely, not only by id
+        same_row = " AND ".join(f'l."{col}" IS main.messages."{col}"' for col in columns(conn, "live", "messages"))
+
+        with Progress() as progress:
+            # mirror the messages deleted or changed since
+            # the last backup, one id range per transaction
+            with profiler.phase("Mirror changes") as phase:
+                task = progress.add_task("Mirroring changes", total=checkpoint)
+                for low, high in id_ranges(conn, "main.messages", args.batch_size):
+                    with transaction(conn):
+                        total_deleted += conn.execute(
+                            f"""
+                            DELETE FROM main.messages
+                            WHERE id > ? AND id <= ?
+                            AND NOT EXISTS (SELECT 1 FROM live.messages l WHERE l.id = main.messages.id AND {same_row})
+                            """,
+                            (low, high),
+                        ).rowcount
+                        total_recopied += conn.execute(
+                            f"""
+                            INSERT INTO main.messages ({cols})
+                            SELECT {cols} FROM live.messages l
+                            WHERE l.id > ? AND l.id <= ?
+                            AND NOT EXISTS (SELECT 1 FROM main.messages m WHERE m.id = l.id)
+                            """,
+                            (low, high),
+                        ).rowcount
+                    progress.update(task, completed=high)
+                    time.sleep(throttle)
+                phase.rows = total_deleted + total_recopied
+
+            with profiler.phase("Copy new messages") as phase:
+                task = progress.add_task("Copying new messages", total=max(live_max - checkpoint, 0))
+                for low, high in id_ranges(conn, "live.messages", args.batch_size, start=checkpoint):
+                    with transaction(conn):
+                        total_copied += conn.execute(
+                            f"""
+                            INSERT INTO main.messages ({cols})
+                            SELECT {cols} FROM live.messages
+                            WHERE id > ? AND id <= ?
+                            """,
+                            (low, high),
+                        ).rowcount
+                    progress.update(task, completed=high - checkpoint)
+                    time.sleep(throttle)
+                phase.rows = total_copied
+
+        # after the messages, so that the sessions (and users) of
+        # the messages copied above are in the backup too
+        with profiler.phase("Mirror small tables"):
+            with transaction(conn):
+                for table in SMALL_TABLES:
+                    cols = ", ".join(f'"{col}"' for col in columns(conn, "live", table))
+                    conn.execute(
+                        f"DELETE FROM main.{table} WHERE NOT EXISTS (SELECT 1 FROM live.{table} l WHERE l.id = main.{table}.id)"
+                    )
+                    conn.execute(f"INSERT OR REPLACE INTO main.{table} ({cols}) SELECT {cols} FROM live.{table}")
+
+        conn.execute("DETACH DATABASE live")
+    except BaseException:
+        conn.close()
+        tmp_file.unlink(missing_ok=True)
+        raise
+    conn.close()
+
+    console.print(
+        f"[bold green]Incremental backup: copied {total_copied} new messages, removed {total_deleted} deleted or changed ones, re-copied {total_recopied}[/bold green]"
+    )
+
+    if not integrity_check(tmp_file):
+        tmp_file.unlink(missing_ok=True)
+        exit(1)
+
+    tmp_file.replace(output_file)
+    console.print(f"[bold green]Backup updated: {output_file}[/bold green]")
+
+
+try:
+    if args.incremental and output_file.exists():
+        incremental_backup()
+    else:
+        if args.incremental:
+            console.print("[yellow]No previous backup found, running a full backup[/yellow]")
+        full_backup()
+except sqlite3.Error:
+    console.print("[red]Backup failed due to a database error[/red]")
+    console.print(traceback.format_exc())
+    exit(1)
@@ -29,11 +29,12 @@ cd "$root_dir"
 mkdir -p "$backup_directory"
 
 sendMessage "[$(date)] [BACKUP] Cleaning database..."
-# Clean redundant data
+# Remove orphaned rows, then clean redundant data (and vacuum)
+python3 tools/orphans.py
 python3 tools/cleaner.py
 
 sendMessage "[$(date)] [BACKUP] Backing up database..."
-sqlite3 "$root_dir/data/markov.db" ".backup $backup_directory/$backup_filename"
+python3 tools/backup.py --markovdb="$root_dir/data/markov.db" --output-file="$backup_directory/$backup_filename"
 sendMessage "[$(date)] [BACKUP] Backup completed"
 
 # syncthing will sync the backup in background
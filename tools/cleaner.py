@@ -2,17 +2,20 @@
 # from the database, and vacuum it, to make it smaller
 # and faster.
 
+# python3 tools/cleaner.py [--markovdb=/path/to/markov.db] [--profile]
+
 import re
 import os
 
-import sqlite3
-
-from pathlib import Path
 from collections import defaultdict
 
-root = Path(__file__).parent.parent
-file = root / "data" / "markov.db"
-env = root / ".env"
+from common import ROOT, batched, connect, new_parser, parse_args, profiler
+
+env = ROOT / ".env"
+
+parser = new_parser("Delete all but the latest KEEP_LAST messages of each session, and vacuum")
+args = parse_args(parser)
+file = args.markovdb
 
 KEEP_LAST_RE = re.compile(r"^KEEP_LAST\s*=\s*(\d+)")
 KEEP_LAST = os.environ.get("KEEP_LAST", None)
@@ -29,29 +32,36 @@ if KEEP_LAST is None:
     # Fall back to default
     KEEP_LAST = 12000  # messages
 
-with sqlite3.connect(file) as conn:
-    count = conn.cursor().execute("SELECT COUNT(1) FROM messages").fetchone()[0]
-    print(f"Fetching {count} messages...")
-    all_messages = conn.cursor().execute("SELECT session, id FROM messages").fetchall()
-    session_messages = defaultdict(set)
+KEEP_LAST = int(KEEP_LAST)
+
+with connect(file) as conn:
+    with profiler.phase("Fetch") as phase:
+        count = conn.cursor().execute("SELECT COUNT(1) FROM messages").fetchone()[0]
+        print(f"Fetching {count} messages...")
+        all_messages = conn.cursor().execute("SELECT session, id FROM messages").fetchall()
+        session_messages = defaultdict(set)
 
-    for message in all_messages:
-        session, mid = message
-        session_messages[session].add(mid)
+        for message in all_messages:
+            session, mid = message
+            session_messages[session].add(mid)
+        phase.rows = len(all_messages)
 
     print("Cleaning messages...")
 
-    cur = conn.cursor()
-    for session, messages in session_messages.items():
-        to_delete = sorted(messages, reverse=True)[KEEP_LAST:]
-        print(f"Deleting {len(to_delete)} messages in session={session}...")
-        for mid in to_delete:
-            cur.execute("DELETE FROM messages WHERE id = ?", (mid,))
+    with profiler.phase("Delete") as phase:
+        cur = conn.cursor()
+        for session, messages in session_messages.items():
+            to_delete = sorted(messages, reverse=True)[KEEP_LAST:]
+            print(f"Deleting {len(to_delete)} messages in session={session}...")
+            for batch in batched(to_delete, 1000):
+                cur.executemany("DELETE FROM messages WHERE id = ?", [(mid,) for mid in batch])
+            phase.rows += len(to_delete)
 
-    conn.commit()
+        conn.commit()
 
-    print("vacuum")
-    conn.execute("VACUUM")
-    conn.commit()
+    with profiler.phase("Vacuum"):
+        print("vacuum")
+        conn.execute("VACUUM")
+        conn.commit()
 
 print("done")
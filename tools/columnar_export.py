@@ -0,0 +1,195 @@
+# python3 tools/columnar_export.py --output-dir=/tmp/corpus [--chat-id=-100123456789] [--markovdb=/path/to/markov.db] [--batch-size=50000] [--profile]
+
+# Export the messages to Parquet files for analytics, one partition per chat
+# (Hive style, so pyarrow, duckdb, polars, spark... can read the whole folder
+# as a single dataset, and skip the chats they don't need):
+#
+# /tmp/corpus/chat_id=-100123456789/part-0.parquet
+# /tmp/corpus/chat_id=-100987654321/part-0.parquet
+# ...
+#
+# Chat ids don't fit in 32 bits, so declare the partition key when reading:
+# ds.dataset(path, partitioning=ds.partitioning(pa.schema([("chat_id", pa.int64())]), flavor="hive"))
+#
+# The rows are streamed from the database in batches, so the memory usage
+# doesn't depend on the size of the corpus. Point --markovdb to a backup
+# (see tools/backup.py) to avoid reading from the live database.
+
+import sqlite3
+import traceback
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rich.progress import Progress
+
+from common import connect, console, new_parser, parse_args, profiler
+
+"""
+database schema:
+CREATE TABLE "chats"(chatId INTEGER NOT NULL UNIQUE, enabled INTEGER NOT NULL, percentage INTEGER NOT NULL, premium INTEGER NOT NULL, banned INTEGER NOT NULL, blockLinks INTEGER NOT NULL, blockUsernames INTEGER NOT NULL, keepSfw INTEGER NOT NULL, markovDisabled INTEGER NOT NULL, quotesDisabled INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, pollsDisabled INTEGER NOT NULL DEFAULT 1)
+CREATE TABLE "messages"(session INTEGER NOT NULL, sender INTEGER NOT NULL, text TEXT NOT NULL, id INTEGER NOT NULL PRIMARY KEY, FOREIGN KEY(session) REFERENCES "sessions"(id) ON DELETE CASCADE, FOREIGN KEY(sender) REFERENCES "users"(id))
+CREATE TABLE "sessions"(name TEXT NOT NULL, uuid TEXT NOT NULL UNIQUE, chat INTEGER NOT NULL, isDefault INTEGER NOT NULL, owoify INTEGER NOT NULL, emojipasta INTEGER NOT NULL, caseSensitive INTEGER NOT NULL, alwaysReply INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, randomReplies INTEGER NOT NULL DEFAULT 0, learningPaused INTEGER NOT NULL DEFAULT 0, FOREIGN KEY(chat) REFERENCES "chats"(id) ON DELETE CASCADE)
+CREATE TABLE "users"(userId INTEGER NOT NULL UNIQUE, admin INTEGER NOT NULL, banned INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, consented INTEGER NOT NULL DEFAULT 0)
+"""
+
+parser = new_parser("Export the messages to Parquet, partitioned by chat")
+parser.add_argument(
+    "--output-dir",
+    type=Path,
+    required=True,
+    help="The (new or empty) directory to write the dataset to",
+)
+parser.add_argument(
+    "--chat-id", type=int, help="Only export the messages from this chat"
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=50000,
+    help="Rows read and written at once (at most one Parquet row group)",
+)
+parser.add_argument(
+    "--compression",
+    type=str,
+    default="zstd",
+    choices=["zstd", "snappy", "gzip", "brotli", "lz4", "none"],
+    help="Parquet compression codec",
+)
+args = parse_args(parser)
+
+output_dir: Path = args.output_dir
+
+if output_dir.exists() and any(output_dir.iterdir()):
+    console.print(f"[red]Directory not empty: {output_dir}[/red]")
+    exit(1)
+
+
+# Sessions that were deleted (see gdpr_export.py) end up in chat_id=-1
+SCHEMA = pa.schema(
+    [
+        pa.field("message_id", pa.int64(), nullable=False),
+        pa.field("session_id", pa.int64(), nullable=False),
+        pa.field("session_name", pa.string(), nullable=False),
+        pa.field("session_deleted", pa.bool_(), nullable=False),
+        pa.field("sender_user_id", pa.int64()),
+        pa.field("text", pa.string(), nullable=False),
+    ]
+)
+# Ids and names repeat a lot within a chat
+DICTIONARY_COLUMNS = ["session_id", "session_name", "sender_user_id"]
+
+QUERY = f"""
+    SELECT
+        COALESCE(c.chatId, -1) AS chat_id,
+        m.id AS message_id,
+        m.session AS session_id,
+        COALESCE(s.name, '') AS session_name,
+        s.id IS NULL AS session_deleted,
+        u.userId AS sender_user_id,
+        m.text AS text
+    FROM messages m
+    LEFT JOIN sessions s ON s.id = m.session
+    LEFT JOIN chats c ON c.id = s.chat
+    LEFT JOIN users u ON u.id = m.sender
+    {"WHERE c.chatId = ?" if args.chat_id is not None else ""}
+    ORDER BY chat_id, m.id
+"""
+PARAMS = (args.chat_id,) if args.chat_id is not None else ()
+
+
+def open_writer(chat_id: int) -> pq.ParquetWriter:
+    partition = output_dir / f"chat_id={chat_id}"
+    partition.mkdir(parents=True)
+    return pq.ParquetWriter(
+        partition / "part-0.parquet",
+        SCHEMA,
+        compression=args.compression,
+        use_dictionary=DICTIONARY_COLUMNS,
+    )
+
+
+def write_rows(writer: pq.ParquetWriter, rows: list[tuple]) -> None:
+    # the rows are (chat_id, message_id, session_id, ...), chat_id is the partition
+    columns = list(zip(*rows))[1:]
+    writer.write_table(
+        pa.Table.from_arrays(
+            [pa.array(column).cast(field.type) for column, field in zip(columns, SCHEMA)],
+            schema=SCHEMA,
+        )
+    )
+
+
+try:
+    # read-only, the export must never write to the database. The sort
+    # by chat spills to disk instead of growing in memory
+    with connect(args.markovdb, readonly=True, temp_store="FILE") as conn:
+
+        if args.chat_id is not None:
+            total_messages = conn.execute(
+                """
+                SELECT COUNT(*) FROM messages m
+                JOIN sessions s ON m.session = s.id
+                JOIN chats c ON s.chat = c.id
+                WHERE c.chatId = ?
+                """,
+                PARAMS,
+            ).fetchone()[0]
+        else:
+            total_messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+        if total_messages == 0:
+            console.print("[bold yellow]No messages found: nothing to do[/bold yellow]")
+            exit(0)
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        console.print(f"[bold green]Exporting {total_messages} messages to {output_dir}...[/bold green]")
+
+        total_chats = 0
+        writer: pq.ParquetWriter | None = None
+        current_chat: int | None = None
+        pending: list[tuple] = []  # rows of current_chat not written yet
+
+        with Progress() as progress, profiler.phase("Export") as phase:
+            task = progress.add_task("Exporting messages...", total=total_messages)
+            cursor = conn.execute(QUERY, PARAMS)
+
+            try:
+                while True:
+                    rows = cursor.fetchmany(args.batch_size)
+                    if not rows:
+                        break
+
+                    # the rows are sorted by chat: a chat is written
+                    # entirely before moving to the next partition
+                    for row in rows:
+                        if row[0] != current_chat:
+                            if pending:
+                                write_rows(writer, pending)
+                                pending = []
+                            if writer is not None:
+                                writer.close()
+                            current_chat = row[0]
+                            writer = open_writer(current_chat)
+                            total_chats += 1
+                        elif len(pending) >= args.batch_size:
+                            write_rows(writer, pending)
+                            pending = []
+                        pending.append(row)
+
+                    progress.update(task, advance=len(rows))
+                    phase.rows += len(rows)
+
+                if pending:
+                    write_rows(writer, pending)
+            finally:
+                if writer is not None:
+                    writer.close()
+except sqlite3.Error:
+    console.print("[red]Failed to export messages due to a database error[/red]")
+    console.print(traceback.format_exc())
+    exit(1)
+
+console.print(
+    f"[bold green]Exported {total_messages} messages from {total_chats} chats to {output_dir}[/bold green]"
+)
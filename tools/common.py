@@ -0,0 +1,208 @@
+# Shared helpers for the scripts in tools/: argument parsing, a tuned
+# connection to the markov database, batching and per-phase profiling.
+#
+# The scripts are run directly (python3 tools/script.py), so this module
+# is imported as `from common import ...`.
+
+import argparse
+import atexit
+import cProfile
+import itertools
+import pstats
+import resource
+import sqlite3
+import time
+import urllib.parse
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TypeVar
+
+from rich.console import Console
+from rich.table import Table
+
+ROOT = Path(__file__).parent.parent
+DEFAULT_MARKOVDB = ROOT / "data" / "markov.db"
+
+CACHE_SIZE = 256 * 1024 * 1024  # bytes of page cache per connection
+MMAP_SIZE = 1024 * 1024 * 1024  # bytes of the database file read through mmap
+
+console = Console()
+
+T = TypeVar("T")
+
+
+def new_parser(description: str, markovdb: bool = True, profile: bool = True) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    if markovdb:
+        parser.add_argument(
+            "--markovdb",
+            type=Path,
+            default=DEFAULT_MARKOVDB,
+            help="The path to the markov database",
+        )
+    if profile:
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Print the wall time, rows/sec and peak memory of each phase",
+        )
+        parser.add_argument(
+            "--profile-output",
+            type=Path,
+            help="Also dump the cProfile stats to this file (implies --profile)",
+        )
+    return parser
+
+
+def parse_args(parser: argparse.ArgumentParser) -> argparse.Namespace:
+    args = parser.parse_args()
+
+    markovdb: Path | None = getattr(args, "markovdb", None)
+    if markovdb is not None and not markovdb.exists():
+        console.print(f"[red]Database not found: {markovdb}[/red]")
+        exit(1)
+
+    if getattr(args, "profile", False) or getattr(args, "profile_output", None) is not None:
+        profiler.enable(args.profile_output)
+    return args
+
+
+def database_uri(path: Path, mode: str) -> str:
+    # ?, # and % in the path would be read as URI syntax
+    return f"file:{urllib.parse.quote(str(path))}?mode={mode}"
+
+
+def connect(
+    path: Path,
+    readonly: bool = False,
+    isolation_level: str | None = "",
+    timeout: float = 30,
+    temp_store: str = "MEMORY",
+) -> sqlite3.Connection:
+    # Read-only connections can never write to the database (not even by mistake).
+    # The journal mode is left to the bot: in WAL mode, commits skip the fsync
+    mode = "ro" if readonly else "rw"
+    conn = sqlite3.connect(
+        database_uri(path, mode), uri=True, timeout=timeout, isolation_level=isolation_level
+    )
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE // 1024}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA temp_store = {temp_store}")
+
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    if not readonly and journal_mode == "wal":
+        conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection, rollback: bool = False) -> Iterator[sqlite3.Connection]:
+    # For connections in autocommit mode (isolation_level=None). The write
+    # lock is taken upfront, so the transaction never fails halfway with SQLITE_BUSY
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    try:
+        conn.execute("ROLLBACK" if rollback else "COMMIT")
+    except sqlite3.Error:
+        # e.g. SQLITE_BUSY on COMMIT, which leaves the transaction open
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def id_ranges(conn: sqlite3.Connection, table: str, batch_size: int, start: int = 0) -> Iterator[tuple[int, int]]:
+    # (low, high] ranges of the primary key, up to the current maximum.
+    # A range is a cheap scan of the table b-tree, however sparse the ids are
+    max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    low = start
+    while low < max_id:
+        high = min(low + batch_size, max_id)
+        yield low, high
+        low = high
+
+
+def human_bytes(num: float, suffix: str = "B") -> str:
+    for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi"]:
+        if abs(num) < 1024:
+            return f"{num:.1f}{unit}{suffix}"
+        num /= 1024
+    return f"{num:.1f}Ei{suffix}"
+
+
+@dataclass
+class Phase:
+    name: str
+    rows: int = 0
+    seconds: float = 0
+    peak_rss: int = 0
+
+
+class Profiler:
+    # Records the phases of a tool, and prints them at exit when enabled
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.phases: list[Phase] = []
+        self.output: Path | None = None
+        self.cprofile: cProfile.Profile | None = None
+
+    def enable(self, output: Path | None = None) -> None:
+        self.enabled = True
+        self.output = output
+        if output is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        # tools often exit() early
+        atexit.register(self.report)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Phase]:
+        phase = Phase(name)
+        self.phases.append(phase)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds = time.perf_counter() - start
+            # the high-water mark of the whole process so far (in KiB on
+            # Linux), not the peak of this phase alone
+            phase.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def report(self) -> None:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            stats = pstats.Stats(self.cprofile)
+            stats.dump_stats(self.output)
+            console.print(f"[bold green]cProfile stats written to {self.output}[/bold green]")
+
+        table = Table(title="Profile")
+        table.add_column("Phase")
+        table.add_column("Wall time", justify="right")
+        table.add_column("Rows", justify="right")
+        table.add_column("Rows/sec", justify="right")
+        table.add_column("Process peak RSS", justify="right")
+        for phase in self.phases:
+            table.add_row(
+                phase.name,
+                f"{phase.seconds:.3f}s",
+                str(phase.rows) if phase.rows else "-",
+                f"{phase.rows / phase.seconds:.0f}" if phase.rows and phase.seconds else "-",
+                human_bytes(phase.peak_rss),
+            )
+        console.print(table)
+
+
+profiler = Profiler()
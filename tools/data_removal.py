@@ -1,13 +1,12 @@
-# python3 tools/data_removal.py --chat-id=-100123456789 --replace-text="Hello, world!" --with-text=""  [--markovdb=/path/to/markov.db]
+# python3 tools/data_removal.py --chat-id=-100123456789 --replace-text="Hello, world!" --with-text=""  [--markovdb=/path/to/markov.db] [--profile]
 
-import argparse
 import sqlite3
-from pathlib import Path
 
 from pydantic import BaseModel
-from rich.console import Console
 from rich.progress import Progress
 
+from common import connect, console, new_parser, parse_args, profiler
+
 """
 database schema:
 CREATE TABLE "chats"(chatId INTEGER NOT NULL UNIQUE, enabled INTEGER NOT NULL, percentage INTEGER NOT NULL, premium INTEGER NOT NULL, banned INTEGER NOT NULL, blockLinks INTEGER NOT NULL, blockUsernames INTEGER NOT NULL, keepSfw INTEGER NOT NULL, markovDisabled INTEGER NOT NULL, quotesDisabled INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, pollsDisabled INTEGER NOT NULL DEFAULT 1)
@@ -16,11 +15,7 @@ CREATE TABLE "sessions"(name TEXT NOT NULL, uuid TEXT NOT NULL UNIQUE, chat INTE
 CREATE TABLE "users"(userId INTEGER NOT NULL UNIQUE, admin INTEGER NOT NULL, banned INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, consented INTEGER NOT NULL DEFAULT 0)
 """
 
-root = Path(__file__).parent.parent
-
-parser = argparse.ArgumentParser(
-    description="Replace text from messages in the database"
-)
+parser = new_parser("Replace text from messages in the database")
 parser.add_argument(
     "--chat-id", type=int, required=True, help="The chat id to remove messages from"
 )
@@ -30,25 +25,13 @@ parser.add_argument(
 parser.add_argument(
     "--with-text", type=str, required=True, help="The text to replace with"
 )
-parser.add_argument(
-    "--markovdb",
-    type=Path,
-    default=root / "data" / "markov.db",
-    help="The path to the markov database",
-)
-args = parser.parse_args()
+args = parse_args(parser)
 
 chat_id = args.chat_id
 replace_text = args.replace_text
 with_text = args.with_text
 markovdb = args.markovdb
 
-console = Console()
-
-if not markovdb.exists():
-    console.print(f"Database not found: {markovdb}")
-    exit(1)
-
 
 ChatId = int
 SessionId = int
@@ -71,11 +54,11 @@ class Chat(BaseModel):
     sessions: list[Session]
 
 
-with sqlite3.connect(markovdb) as conn:
+with connect(markovdb) as conn:
     # Enable row factory to access columns by name
     conn.row_factory = sqlite3.Row
 
-    with Progress() as progress:
+    with Progress() as progress, profiler.phase("Replace text") as phase:
         chat = Chat(chat_id=chat_id, sessions=[])
         cursor = conn.cursor()
 
@@ -127,6 +110,8 @@ with sqlite3.connect(markovdb) as conn:
 
         console.print(f"[bold green]Total messages: {total_messages}[/bold green]")
         task = progress.add_task("Replacing text", total=total_messages)
+        # the messages are updated while being read: use another cursor
+        write_cursor = conn.cursor()
 
         for session in chat.sessions:
             cursor.execute(
@@ -140,18 +125,19 @@ with sqlite3.connect(markovdb) as conn:
 
                 for message in messages:
                     progress.update(task, advance=1)
+                    phase.rows += 1
                     message_id = message["id"]
                     text = message["text"]
 
                     if replace_text in text:
                         new_text = text.replace(replace_text, with_text)
                         if not new_text.strip():
-                            cursor.execute(
+                            write_cursor.execute(
                                 "DELETE FROM messages WHERE id = ?", (message_id,)
                             )
                             total_deleted += 1
                         else:
-                            cursor.execute(
+                            write_cursor.execute(
                                 "UPDATE messages SET text = ? WHERE id = ?",
                                 (new_text, message_id),
                             )
@@ -160,9 +146,10 @@ with sqlite3.connect(markovdb) as conn:
     console.print("[bold green]Committing changes...[/bold green]")
     conn.commit()
     # VACUUM the database to free up space
-    console.print("[bold green]Vacuuming database...[/bold green]")
-    conn.execute("VACUUM")
-    conn.commit()
+    with profiler.phase("Vacuum"):
+        console.print("[bold green]Vacuuming database...[/bold green]")
+        conn.execute("VACUUM")
+        conn.commit()
     console.print("[bold green]Database vacuumed[/bold green]")
     # Done! Total messages: 1000, deleted: 100, updated: 900
     console.print(
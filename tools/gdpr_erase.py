@@ -0,0 +1,239 @@
+# python3 tools/gdpr_erase.py --users-file=/tmp/erasure_requests.txt [--scrub-mentions] [--audit-log=/path/to/audit.jsonl] [--markovdb=/path/to/markov.db] [--dry-run] [--profile]
+# cat /tmp/erasure_requests.txt | python3 tools/gdpr_erase.py --users-file=-
+
+# Erase the messages of many users at once. The users file has one user per
+# line, with their Telegram user id and optionally their @usernames:
+#
+# 12345678
+# 87654321 @someone @someone_old
+#
+# The messages table is scanned once for all the users, one id range per
+# transaction, and the database is vacuumed once at the end. With
+# --scrub-mentions, the @usernames are also removed from everyone else's
+# messages (messages left empty are deleted). The deleted messages are
+# counted per user and appended to the audit log.
+
+import datetime
+import re
+import sqlite3
+import sys
+import traceback
+from collections import Counter
+from pathlib import Path
+
+import orjson
+from rich.progress import Progress
+
+from common import ROOT, connect, console, id_ranges, new_parser, parse_args, profiler, transaction
+
+parser = new_parser("Erase the messages of many users in one pass")
+parser.add_argument(
+    "--users-file",
+    type=str,
+    required=True,
+    help="The file with the users to erase, one per line ('-' for stdin)",
+)
+parser.add_argument(
+    "--scrub-mentions",
+    action="store_true",
+    help="Also remove the users' @usernames from the other messages",
+)
+parser.add_argument(
+    "--audit-log",
+    type=Path,
+    default=ROOT / "data" / "erasure_audit.jsonl",
+    help="The file to append the audit records to",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=50000,
+    help="Range of message ids processed per transaction",
+)
+parser.add_argument(
+    "--no-vacuum",
+    action="store_true",
+    help="Don't vacuum the database at the end",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Only count what would be deleted, without changing anything",
+)
+args = parse_args(parser)
+
+if args.users_file != "-" and not Path(args.users_file).exists():
+    console.print(f"[red]Users file not found: {args.users_file}[/red]")
+    exit(1)
+
+
+UserId = int
+InternalUserId = int
+
+usernames: dict[str, UserId] = {}  # (lowercase @username): user id
+requested: list[UserId] = []
+
+with open(args.users_file) if args.users_file != "-" else sys.stdin as f:
+    for number, line in enumerate(f, start=1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+
+        try:
+            user_id = int(fields[0])
+        except ValueError:
+            console.print(f"[red]Invalid user id at line {number}: {fields[0]}[/red]")
+            exit(1)
+
+        requested.append(user_id)
+        for username in fields[1:]:
+            usernames["@" + username.lstrip("@").lower()] = user_id
+
+requested = list(dict.fromkeys(requested))
+if not requested:
+    console.print("[bold yellow]No users found in the users file: nothing to do[/bold yellow]")
+    exit(0)
+
+MENTIONS_RE = (
+    re.compile(
+        r"(?<!\w)(" + "|".join(re.escape(username) for username in usernames) + r")(?!\w)",
+        flags=re.IGNORECASE,
+    )
+    if args.scrub_mentions and usernames
+    else None
+)
+
+if args.scrub_mentions and MENTIONS_RE is None:
+    console.print("[yellow]No @usernames in the users file: there are no mentions to scrub[/yellow]")
+
+
+def has_mentions(text: str) -> bool:
+    return MENTIONS_RE.search(text) is not None
+
+
+deleted: Counter[UserId] = Counter()
+scrubbed: Counter[UserId] = Counter()
+total_deleted = 0
+total_scrubbed = 0
+
+def write_audit(found: set[UserId], complete: bool) -> None:
+    date = datetime.datetime.now(tz=datetime.UTC).isoformat()
+    with args.audit_log.open("ab") as f:
+        for user_id in requested:
+            f.write(
+                orjson.dumps(
+                    {
+                        "date": date,
+                        "user_id": user_id,
+                        "found": user_id in found,
+                        "complete": complete,
+                        "messages_deleted": deleted[user_id],
+                        "mentions_scrubbed": scrubbed[user_id],
+                    }
+                )
+                + b"\n"
+            )
+    if complete:
+        console.print(f"[bold green]Audit records appended to {args.audit_log}[/bold green]")
+    else:
+        console.print(f"[yellow]Erasure interrupted: partial audit records appended to {args.audit_log}[/yellow]")
+
+
+try:
+    with connect(args.markovdb, isolation_level=None) as conn:
+        conn.create_function("has_mentions", 1, has_mentions, deterministic=True)
+
+        conn.execute("CREATE TEMP TABLE erasure (userId INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO temp.erasure VALUES (?)", [(user_id,) for user_id in requested])
+
+        # resolve all the users at once, through the users.userId unique index
+        conn.execute(
+            """
+            CREATE TEMP TABLE erasure_senders AS
+            SELECT u.id AS id, u.userId AS userId
+            FROM temp.erasure e JOIN users u ON u.userId = e.userId
+            """
+        )
+        internal_ids: dict[InternalUserId, UserId] = dict(
+            conn.execute("SELECT id, userId FROM temp.erasure_senders")
+        )
+        console.print(
+            f"[bold green]{len(internal_ids)} of {len(requested)} users found in the database[/bold green]"
+        )
+
+        # the audit records are written as soon as the erasure stops, even
+        # halfway through: the committed ranges can't be undone
+        complete = False
+        try:
+            with Progress() as progress, profiler.phase("Erase") as phase:
+                ranges = list(id_ranges(conn, "messages", args.batch_size))
+                task = progress.add_task("Erasing messages", total=len(ranges))
+
+                for low, high in ranges:
+                    # only counted once the range is committed
+                    range_deleted: Counter[UserId] = Counter()
+                    range_scrubbed: Counter[UserId] = Counter()
+                    range_scrubbed_messages = 0
+
+                    with transaction(conn, rollback=args.dry_run):
+                        for sender, count in conn.execute(
+                            """
+                            SELECT sender, COUNT(*) FROM messages
+                            WHERE id > ? AND id <= ? AND sender IN (SELECT id FROM temp.erasure_senders)
+                            GROUP BY sender
+                            """,
+                            (low, high),
+                        ):
+                            range_deleted[internal_ids[sender]] += count
+
+                        conn.execute(
+                            """
+                            DELETE FROM messages
+                            WHERE id > ? AND id <= ? AND sender IN (SELECT id FROM temp.erasure_senders)
+                            """,
+                            (low, high),
+                        )
+
+                        if MENTIONS_RE is not None:
+                            for message_id, text in conn.execute(
+                                "SELECT id, text FROM messages WHERE id > ? AND id <= ? AND has_mentions(text)",
+                                (low, high),
+                            ).fetchall():
+                                for username in {m.lower() for m in MENTIONS_RE.findall(text)}:
+                                    range_scrubbed[usernames[username]] += 1
+                                range_scrubbed_messages += 1
+
+                                new_text = MENTIONS_RE.sub("", text)
+                                if not new_text.strip():
+                                    conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+                                else:
+                                    conn.execute(
+                                        "UPDATE messages SET text = ? WHERE id = ?", (new_text, message_id)
+                                    )
+
+                    deleted.update(range_deleted)
+                    scrubbed.update(range_scrubbed)
+                    total_deleted += range_deleted.total()
+                    total_scrubbed += range_scrubbed_messages
+                    progress.update(task, advance=1)
+                phase.rows = total_deleted + total_scrubbed
+            complete = True
+        finally:
+            if not args.dry_run:
+                write_audit(set(internal_ids.values()), complete)
+
+        if args.dry_run:
+            console.print("[bold yellow]Dry run: no changes were made[/bold yellow]")
+        elif not args.no_vacuum:
+            console.print("[bold green]Vacuuming database...[/bold green]")
+            with profiler.phase("Vacuum"):
+                conn.execute("VACUUM")
+except sqlite3.Error:
+    console.print("[red]Failed to erase messages due to a database error[/red]")
+    console.print(traceback.format_exc())
+    exit(1)
+
+
+console.print(
+    f"[bold green]Done! Users: {len(requested)}, messages deleted: {total_deleted}, messages scrubbed: {total_scrubbed}[/bold green]"
+)
@@ -1,7 +1,6 @@
-# python3 tools/gdpr_export.py --user-id=12345678 --output-file=/tmp/export.json [--markovdb=/path/to/markov.db]
-# python3 tools/gdpr_export.py --chat-id=-100123456789 --output-file=/tmp/export.json [--markovdb=/path/to/markov.db]
+# python3 tools/gdpr_export.py --user-id=12345678 --output-file=/tmp/export.json [--markovdb=/path/to/markov.db] [--profile]
+# python3 tools/gdpr_export.py --chat-id=-100123456789 --output-file=/tmp/export.json [--markovdb=/path/to/markov.db] [--profile]
 
-import argparse
 import datetime
 import sqlite3
 import traceback
@@ -9,9 +8,10 @@ from pathlib import Path
 
 import orjson
 from pydantic import BaseModel
-from rich.console import Console
 from rich.progress import Progress
 
+from common import connect, console, new_parser, parse_args, profiler
+
 """
 Export shape (user export):
 {
@@ -60,9 +60,7 @@ CREATE TABLE "sessions"(name TEXT NOT NULL, uuid TEXT NOT NULL UNIQUE, chat INTE
 CREATE TABLE "users"(userId INTEGER NOT NULL UNIQUE, admin INTEGER NOT NULL, banned INTEGER NOT NULL, id INTEGER NOT NULL PRIMARY KEY, consented INTEGER NOT NULL DEFAULT 0)
 """
 
-root = Path(__file__).parent.parent
-
-parser = argparse.ArgumentParser(description="Export messages from the database")
+parser = new_parser("Export messages from the database")
 target_group = parser.add_mutually_exclusive_group(required=True)
 target_group.add_argument(
     "--user-id", type=int, help="Export all messages sent by this user"
@@ -76,15 +74,7 @@ parser.add_argument(
     required=True,
     help="The output file to write the export to",
 )
-parser.add_argument(
-    "--markovdb",
-    type=Path,
-    default=root / "data" / "markov.db",
-    help="The path to the markov database",
-)
-args = parser.parse_args()
-
-console = Console()
+args = parse_args(parser)
 
 output_file = args.output_file
 output_dir = output_file.parent
@@ -94,11 +84,6 @@ if not output_dir.exists() or not output_dir.is_dir():
     exit(1)
 
 
-if not markovdb.exists():
-    console.print(f"[red]Database not found: {markovdb}[/red]")
-    exit(1)
-
-
 ChatId = int
 InternalChatId = int
 SessionId = int
@@ -143,7 +128,7 @@ class ExportData(BaseModel):
     chats: list[Chat]
 
 
-with sqlite3.connect(markovdb) as conn:
+with connect(markovdb, readonly=True) as conn:
     # enable row factory to access columns by name
     conn.row_factory = sqlite3.Row
 
@@ -206,7 +191,7 @@ with sqlite3.connect(markovdb) as conn:
             f"[bold green]Exporting {total_messages} messages for {export_type} target...[/bold green]"
         )
 
-        with Progress() as progress:
+        with Progress() as progress, profiler.phase("Export") as phase:
             task = progress.add_task("Exporting messages...", total=total_messages)
 
             if export_type == "user":
@@ -235,6 +220,7 @@ with sqlite3.connect(markovdb) as conn:
                 if not messages_chunk:
                     break
 
+                phase.rows += len(messages_chunk)
                 for message in messages_chunk:
                     progress.update(task, advance=1)
                     session_id: SessionId = message["session"]
@@ -320,7 +306,7 @@ with sqlite3.connect(markovdb) as conn:
         exit(1)
 
 
-with console.status("[bold green]Writing export data..."):
+with console.status("[bold green]Writing export data..."), profiler.phase("Write"):
     with output_file.open("wb") as f:
         f.write(orjson.dumps(export_data.model_dump(), option=orjson.OPT_INDENT_2))
 
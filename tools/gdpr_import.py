@@ -1,6 +1,5 @@
-# python3 tools/gdpr_import.py --export-file=/tmp/export.json --chat-id=-100123456789 [--markovdb=/path/to/markov.db] [--session-name="Imported session"]
+# python3 tools/gdpr_import.py --export-file=/tmp/export.json --chat-id=-100123456789 [--markovdb=/path/to/markov.db] [--session-name="Imported session"] [--profile]
 
-import argparse
 import datetime
 import sqlite3
 import traceback
@@ -8,14 +7,11 @@ import uuid
 from pathlib import Path
 
 import orjson
-from rich.console import Console
 from rich.progress import Progress
 
-root = Path(__file__).parent.parent
+from common import connect, console, new_parser, parse_args, profiler
 
-parser = argparse.ArgumentParser(
-    description="Import messages from a GDPR export into a new session"
-)
+parser = new_parser("Import messages from a GDPR export into a new session")
 parser.add_argument(
     "--export-file",
     type=Path,
@@ -28,20 +24,12 @@ parser.add_argument(
     required=True,
     help="The chat id where the session will be created",
 )
-parser.add_argument(
-    "--markovdb",
-    type=Path,
-    default=root / "data" / "markov.db",
-    help="The path to the markov database",
-)
 parser.add_argument(
     "--session-name",
     type=str,
     help="Optional name for the new session",
 )
-args = parser.parse_args()
-
-console = Console()
+args = parse_args(parser)
 
 export_file = args.export_file
 chat_id = args.chat_id
@@ -53,11 +41,6 @@ if not export_file.exists():
     exit(1)
 
 
-if not markovdb.exists():
-    console.print(f"[red]Database not found: {markovdb}[/red]")
-    exit(1)
-
-
 try:
     export_data = orjson.loads(export_file.read_bytes())
 except Exception:
@@ -131,7 +114,7 @@ if export_type == "chat" and export_chat_id is not None and export_chat_id != ch
 
 
 try:
-    with sqlite3.connect(markovdb, timeout=30, isolation_level=None) as conn:
+    with connect(markovdb, isolation_level=None) as conn:
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
         conn.execute("BEGIN IMMEDIATE")
@@ -192,7 +175,7 @@ try:
             "SELECT COALESCE(MAX(id), 0) AS max_id FROM messages"
         ).fetchone()["max_id"]
 
-        with Progress() as progress:
+        with Progress() as progress, profiler.phase("Import") as phase:
             task = progress.add_task("Importing messages", total=len(messages))
 
             for message in messages:
@@ -203,6 +186,7 @@ try:
                     (last_message_id, new_session_id, sender_internal_id, message["text"]),
                 )
                 progress.update(task, advance=1)
+                phase.rows += 1
 
         conn.commit()
         console.print(
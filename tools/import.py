@@ -6,22 +6,19 @@
 # sender: int (the sender's id)
 # text: str (the message text)
 
-import argparse
+# python3 tools/import.py /path/to/messages.csv [--markovdb=/path/to/markov.db] [--profile]
+
 import csv
 import sqlite3
 import traceback
 from dataclasses import dataclass
 from pathlib import Path
 
-root = Path(__file__).parent.parent
-markovdb = root / "data" / "markov.db"
-env = root / ".env"
+from common import batched, connect, new_parser, parse_args, profiler
 
-parser = argparse.ArgumentParser(
-    description="Import messages from a CSV file into the database"
-)
+parser = new_parser("Import messages from a CSV file into the database")
 parser.add_argument("file", type=Path, help="The CSV file to import")
-args = parser.parse_args()
+args = parse_args(parser)
 
 csv_file = args.file
 if not csv_file.exists():
@@ -58,7 +55,7 @@ with csv_file.open() as f:
         )
 
 
-with sqlite3.connect(markovdb) as conn:
+with connect(args.markovdb) as conn, profiler.phase("Insert") as phase:
     try:
         last_message_id = (
             conn.cursor().execute("SELECT MAX(id) FROM messages").fetchone()[0]
@@ -72,12 +69,16 @@ with sqlite3.connect(markovdb) as conn:
         print(f"Inserting {len(messages)} messages...")
         cur = conn.cursor()
 
-        for message in messages:
-            last_message_id += 1
-            cur.execute(
+        for batch in batched(messages, 1000):
+            cur.executemany(
                 "INSERT INTO messages (id, session, sender, text) VALUES (?, ?, ?, ?)",
-                (last_message_id, message.session, message.sender, message.text),
+                [
+                    (last_message_id + i, message.session, message.sender, message.text)
+                    for i, message in enumerate(batch, start=1)
+                ],
             )
+            last_message_id += len(batch)
+            phase.rows += len(batch)
 
         conn.commit()
     except sqlite3.OperationalError:
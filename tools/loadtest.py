@@ -0,0 +1,506 @@
+# python3 tools/loadtest.py --bot-command=./markinim [--start-timeout=60] [--port=8081] [--chats=200] [--users=1000] [--updates=20000] [--rate=200]
+# python3 tools/loadtest.py --updates-file=/path/to/updates.jsonl [--rate=200] [--bot-pid=12345]
+
+# Load tester for the bot. It runs a local stand-in for the Telegram Bot API
+# and replays a stream of updates to the bot at a fixed rate: either recorded
+# updates (one Update object per line, in JSON) or a synthetic stream of many
+# chats with skewed activity, with commands mixed with plain text.
+#
+# Either let it start the bot (--bot-command), or start it first and then
+# run the bot against it, e.g. BOT_API_URL=http://127.0.0.1:8081 ./markinim
+# The bot started by the load tester runs on a temporary copy of --markovdb
+# (through MARKOV_DB, unless secret.ini sets `database`), so the synthetic
+# users, chats and messages never reach the real database. When starting
+# the bot yourself, point it to a copy of the database.
+#
+# At the end it reports the updates/sec processed by the bot, the p50/p99
+# latency of the replies and (with --bot-pid) the memory growth of the bot.
+
+import atexit
+import email.parser
+import email.policy
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import string
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from rich.progress import Progress
+from rich.table import Table
+
+from common import DEFAULT_MARKOVDB, connect, console, human_bytes, new_parser, parse_args
+
+parser = new_parser(
+    # the measures are of the bot, not of this process
+    "Replay updates to the bot through a local fake Telegram Bot API", markovdb=False, profile=False
+)
+parser.add_argument("--host", type=str, default="127.0.0.1", help="The address to listen on")
+parser.add_argument("--port", type=int, default=8081, help="The port to listen on")
+parser.add_argument(
+    "--updates-file",
+    type=Path,
+    help="Replay the updates from this file (JSON lines) instead of generating them",
+)
+parser.add_argument("--chats", type=int, default=200, help="Synthetic group chats")
+parser.add_argument("--users", type=int, default=1000, help="Synthetic users")
+parser.add_argument("--updates", type=int, default=20000, help="Synthetic updates to send")
+parser.add_argument(
+    "--skew",
+    type=float,
+    default=1.1,
+    help="Zipf exponent of the chats activity (0 = uniform)",
+)
+parser.add_argument(
+    "--command-ratio",
+    type=float,
+    default=0.05,
+    help="Ratio of synthetic updates that are commands",
+)
+parser.add_argument("--rate", type=float, default=200, help="Updates sent per second")
+parser.add_argument(
+    "--no-setup",
+    action="store_true",
+    help="Don't make the synthetic users give consent (/enable) before the replay",
+)
+parser.add_argument(
+    "--drain-timeout",
+    type=float,
+    default=30,
+    help="Seconds to wait for the bot to catch up after the last update",
+)
+parser.add_argument(
+    "--start-timeout",
+    type=float,
+    default=60,
+    help="Seconds to wait for the bot to start polling",
+)
+bot_group = parser.add_mutually_exclusive_group()
+bot_group.add_argument(
+    "--bot-command",
+    type=str,
+    help="Start the bot with this command, pointed to the fake Bot API",
+)
+bot_group.add_argument("--bot-pid", type=int, help="Pid of the bot, to track its memory usage")
+parser.add_argument(
+    "--markovdb",
+    dest="source_db",  # may not exist, unlike the --markovdb of the other tools
+    type=Path,
+    default=DEFAULT_MARKOVDB,
+    help="The database the bot started with --bot-command runs on a copy of (empty if it doesn't exist)",
+)
+parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic stream")
+args = parse_args(parser)
+
+if args.updates_file is not None and not args.updates_file.exists():
+    console.print(f"[red]Updates file not found: {args.updates_file}[/red]")
+    exit(1)
+
+if args.bot_pid is not None and not Path(f"/proc/{args.bot_pid}/status").exists():
+    console.print(f"[red]Process not found: {args.bot_pid}[/red]")
+    exit(1)
+
+
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Markinim",
+    "username": "markinim_loadtest_bot",
+}
+LONG_POLL_CAP = 5  # seconds a getUpdates call is held at most
+
+
+class FakeBotApi:
+    # The state shared by the fake Bot API and the replay driver
+
+    def __init__(self) -> None:
+        self.lock = threading.Condition()
+        self.updates: list[dict] = []
+        self.confirmed = 0  # updates confirmed by the bot through the offset
+        self.delivered_at: dict[int, float] = {}  # update_id: first delivery time
+        self.confirmed_at: list[float] = []
+        self.pending_replies: dict[int, float] = {}  # chat_id: delivery time
+        self.latencies: list[float] = []
+        self.calls: Counter[str] = Counter()
+        self.polling = threading.Event()  # the bot is long polling
+        self.message_ids = itertools.count(1)
+
+    def push(self, update: dict) -> None:
+        with self.lock:
+            update["update_id"] = len(self.updates) + 1
+            self.updates.append(update)
+            self.lock.notify_all()
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> list[dict]:
+        with self.lock:
+            if offset < 0:
+                # like Telegram: confirm everything but the last -offset updates
+                offset = max(len(self.updates) + offset + 1, 1)
+            now = time.perf_counter()
+            while self.confirmed < min(offset - 1, len(self.updates)):
+                self.confirmed += 1
+                self.confirmed_at.append(now)
+
+            deadline = time.monotonic() + min(timeout, LONG_POLL_CAP)
+            while len(self.updates) < max(offset, 1) and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+
+            batch = self.updates[max(offset, 1) - 1 :][:limit]
+            now = time.perf_counter()
+            for update in batch:
+                if update["update_id"] not in self.delivered_at:
+                    self.delivered_at[update["update_id"]] = now
+                    chat_id = update_chat_id(update)
+                    if chat_id is not None:
+                        self.pending_replies[chat_id] = now
+            return batch
+
+    def reply(self, method: str, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        with self.lock:
+            self.calls[method] += 1
+            # the latency is measured from the delivery of the
+            # latest update of the same chat, approximately
+            delivered = self.pending_replies.pop(chat_id, None)
+            if delivered is not None:
+                self.latencies.append(time.perf_counter() - delivered)
+
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1000, "height": 1000}]
+        if method == "sendPoll":
+            options = params.get("options", "[]")
+            message["poll"] = {
+                "id": str(message["message_id"]),
+                "question": params.get("question", ""),
+                "options": [
+                    {"text": option["text"] if isinstance(option, dict) else option, "voter_count": 0}
+                    for option in json.loads(options)
+                ],
+                "total_voter_count": 0,
+                "is_closed": False,
+                "is_anonymous": True,
+                "type": "regular",
+                "allows_multiple_answers": False,
+            }
+        return message
+
+
+def update_chat_id(update: dict) -> int | None:
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+
+api = FakeBotApi()
+
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                params[name] = part.get_filename()
+            else:
+                params[name] = part.get_payload(decode=True).decode(errors="replace")
+        return params
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    return dict(urllib.parse.parse_qsl(body.decode(errors="replace")))
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        self.handle_method()
+
+    def do_POST(self) -> None:
+        self.handle_method()
+
+    def handle_method(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_params(self.headers.get("Content-Type", ""), self.rfile.read(length)))
+
+        match method:
+            case "getMe":
+                result = BOT_USER
+            case "getUpdates":
+                timeout = float(params.get("timeout", 0))
+                if timeout > 0:
+                    api.polling.set()
+                result = api.get_updates(
+                    offset=int(params.get("offset", 0)),
+                    limit=int(params.get("limit", 100)),
+                    timeout=timeout,
+                )
+            case "getChatMember":
+                result = {
+                    "status": "member",
+                    "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"},
+                }
+            case "sendMessage" | "sendPhoto" | "sendPoll" | "editMessageText":
+                result = api.reply(method, params)
+            case _:
+                # answerCallbackQuery, deleteMessage, leaveChat...
+                with api.lock:
+                    api.calls[method] += 1
+                result = True
+
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def message_update(chat: dict, user_id: int, text: str) -> dict:
+    return {
+        "message": {
+            "message_id": next(api.message_ids),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        }
+    }
+
+
+def synthetic_updates() -> tuple[list[dict], list[dict]]:
+    rng = random.Random(args.seed)
+    vocabulary = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(5000)
+    ]
+    commands = ["/markov", "/markov {word}", "/quote", "/wouldyourather"]
+    users = [2000000000 + i for i in range(args.users)]
+    chats = [
+        {"id": -1000000000000 - i, "type": "supergroup", "title": f"Group {i}"}
+        for i in range(args.chats)
+    ]
+    # skewed activity: a few chats get most of the messages
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(chats))]
+    # every chat has its own regulars
+    members = {chat["id"]: rng.sample(users, k=min(len(users), rng.randint(3, 50))) for chat in chats}
+
+    setup = []
+    if not args.no_setup:
+        for user_id in users:
+            chat = {"id": user_id, "type": "private", "first_name": f"User {user_id}"}
+            setup.append(message_update(chat, user_id, "/enable"))
+
+    updates = []
+    for chat in rng.choices(chats, weights=weights, k=args.updates):
+        user_id = rng.choice(members[chat["id"]])
+        if rng.random() < args.command_ratio:
+            text = rng.choice(commands).format(word=rng.choice(vocabulary))
+        else:
+            text = " ".join(rng.choices(vocabulary, k=rng.randint(1, 20)))
+        updates.append(message_update(chat, user_id, text))
+    return setup, updates
+
+
+def recorded_updates() -> list[dict]:
+    updates = []
+    with args.updates_file.open() as f:
+        for line in f:
+            if line.strip():
+                update = json.loads(line)
+                update.pop("update_id", None)
+                updates.append(update)
+    return updates
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    # zombie: the bot exited, but wasn't reaped yet
+    raise ProcessLookupError(pid)
+
+
+def wait_confirmed(total: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with api.lock:
+            if api.confirmed >= total:
+                return True
+        time.sleep(0.1)
+    return False
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+server = ThreadingHTTPServer((args.host, args.port), BotApiHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+if args.updates_file is not None:
+    setup, updates = [], recorded_updates()
+else:
+    setup, updates = synthetic_updates()
+
+api_url = f"http://{args.host}:{args.port}"
+console.print(f"[bold green]Fake Bot API listening on {api_url}[/bold green]")
+
+bot_process = None
+if args.bot_command is not None:
+    workdir = Path(tempfile.mkdtemp(prefix="markinim-loadtest-"))
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    bot_db = workdir / "markov.db"
+    if args.source_db.exists():
+        with console.status(f"[bold green]Copying {args.source_db} for the bot..."):
+            with connect(args.source_db, readonly=True) as source, sqlite3.connect(bot_db) as target:
+                source.backup(target)
+
+    bot_process = subprocess.Popen(
+        # exec, so that the pid is the bot's and not the shell's
+        f"exec {args.bot_command}",
+        shell=True,
+        env=os.environ
+        | {
+            "BOT_API_URL": api_url,
+            "BOT_TOKEN": os.environ.get("BOT_TOKEN", "1:loadtest"),
+            "MARKOV_DB": str(bot_db),
+        },
+    )
+    args.bot_pid = bot_process.pid
+
+with console.status("[bold green]Waiting for the bot to start polling..."):
+    deadline = time.monotonic() + args.start_timeout
+    while not api.polling.wait(0.5):
+        if bot_process is not None and bot_process.poll() is not None:
+            console.print(f"[red]The bot exited with code {bot_process.returncode} before polling[/red]")
+            server.shutdown()
+            exit(1)
+        if args.bot_pid is not None and not Path(f"/proc/{args.bot_pid}").exists():
+            console.print(f"[red]The bot (pid {args.bot_pid}) exited before polling[/red]")
+            server.shutdown()
+            exit(1)
+        if time.monotonic() > deadline:
+            console.print(f"[red]The bot didn't start polling within {args.start_timeout:g} seconds[/red]")
+            if bot_process is not None:
+                bot_process.terminate()
+                bot_process.wait()
+            server.shutdown()
+            exit(1)
+
+first_update = 0
+rss_samples: list[int] = []
+stop_sampling = threading.Event()
+started: float | None = None
+sent_in: float | None = None
+drained = False
+
+try:
+    if setup:
+        with console.status(f"[bold green]Sending {len(setup)} setup updates..."):
+            for update in setup:
+                api.push(update)
+            if not wait_confirmed(len(setup), args.drain_timeout):
+                console.print("[yellow]The bot didn't confirm all the setup updates in time[/yellow]")
+
+    # the measures only cover the replay
+    with api.lock:
+        api.latencies.clear()
+        api.calls.clear()
+        api.pending_replies.clear()
+        first_update = len(api.updates)
+
+    def sample_rss() -> None:
+        while not stop_sampling.is_set():
+            try:
+                rss_samples.append(rss_bytes(args.bot_pid))
+            except (FileNotFoundError, ProcessLookupError):
+                console.print("[yellow]The bot exited: memory sampling stopped[/yellow]")
+                return
+            stop_sampling.wait(0.5)
+
+    if args.bot_pid is not None:
+        threading.Thread(target=sample_rss, daemon=True).start()
+
+    started = time.perf_counter()
+    with Progress() as progress:
+        task = progress.add_task("Replaying updates", total=len(updates))
+        for i, update in enumerate(updates):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            api.push(update)
+            progress.update(task, advance=1)
+    sent_in = time.perf_counter() - started
+
+    with console.status("[bold green]Waiting for the bot to catch up..."):
+        drained = wait_confirmed(first_update + len(updates), args.drain_timeout)
+except KeyboardInterrupt:
+    console.print("[yellow]Interrupted, reporting partial results[/yellow]")
+finally:
+    stop_sampling.set()
+
+with api.lock:
+    confirmed_at = api.confirmed_at[first_update:] if started is not None else []
+    latencies = list(api.latencies)
+    calls = dict(api.calls)
+
+if not drained:
+    console.print("[yellow]The bot didn't confirm every update: results are partial[/yellow]")
+
+table = Table(title="Load test results")
+table.add_column("Metric")
+table.add_column("Value", justify="right")
+table.add_row("Updates sent", str(len(updates)))
+if sent_in:
+    table.add_row("Send rate", f"{len(updates) / sent_in:.1f}/s")
+table.add_row("Updates processed", str(len(confirmed_at)))
+if confirmed_at:
+    elapsed = confirmed_at[-1] - started
+    table.add_row("Throughput", f"{len(confirmed_at) / elapsed:.1f} updates/s" if elapsed > 0 else "-")
+table.add_row("Replies", str(len(latencies)))
+table.add_row("Reply latency p50", f"{percentile(latencies, 50) * 1000:.1f}ms")
+table.add_row("Reply latency p99", f"{percentile(latencies, 99) * 1000:.1f}ms")
+for method, count in sorted(calls.items()):
+    table.add_row(f"  {method}", str(count))
+if rss_samples:
+    table.add_row("Bot RSS (start)", human_bytes(rss_samples[0]))
+    table.add_row("Bot RSS (peak)", human_bytes(max(rss_samples)))
+    table.add_row("Bot RSS (end)", human_bytes(rss_samples[-1]))
+    table.add_row("Bot RSS growth", human_bytes(rss_samples[-1] - rss_samples[0]))
+console.print(table)
+
+if bot_process is not None:
+    bot_process.terminate()
+    bot_process.wait()
+server.shutdown()
@@ -0,0 +1,132 @@
+# python3 tools/orphans.py [--dry-run] [--vacuum] [--markovdb=/path/to/markov.db] [--batch-size=10000] [--profile]
+
+# Find and remove the rows left behind by deletions without cascade (the bot
+# doesn't enable SQLite foreign keys):
+# - sessions whose chat doesn't exist anymore;
+# - messages whose session (or sender) doesn't exist anymore, or belongs
+#   to an orphaned session.
+#
+# Users are never orphans: they don't reference other rows, and the bot
+# stores every sender (see getOrInsert), whether or not they have messages.
+#
+# Each table is scanned once, looking the references up by primary key.
+# The messages are removed in batches, one transaction each. The nightly
+# backup script runs this before tools/cleaner.py, which vacuums.
+
+import sqlite3
+import traceback
+
+from rich.progress import Progress
+from rich.table import Table
+
+from common import batched, connect, console, human_bytes, new_parser, parse_args, profiler, transaction
+
+parser = new_parser("Remove orphaned messages and sessions")
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=10000,
+    help="Messages deleted per transaction",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Only report the orphans, without removing them",
+)
+parser.add_argument(
+    "--vacuum",
+    action="store_true",
+    help="Vacuum the database after removing the orphans",
+)
+args = parse_args(parser)
+
+
+def table_size(conn: sqlite3.Connection, table: str) -> int | None:
+    # dbstat is an optional SQLite extension
+    try:
+        return conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (table,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+try:
+    with connect(args.markovdb, isolation_level=None) as conn:
+        with console.status("[bold green]Looking for orphans..."), profiler.phase("Scan"):
+            # the bot keeps writing: anything newer than this is not an orphan
+            scan_max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            conn.execute(
+                """
+                CREATE TEMP TABLE orphan_sessions AS
+                SELECT s.id AS id, LENGTH(CAST(s.name AS BLOB)) + LENGTH(s.uuid) AS size
+                FROM sessions s
+                WHERE NOT EXISTS (SELECT 1 FROM chats c WHERE c.id = s.chat)
+                """
+            )
+            conn.execute(
+                """
+                CREATE TEMP TABLE orphan_messages AS
+                SELECT m.id AS id, LENGTH(CAST(m.text AS BLOB)) AS size
+                FROM messages m
+                WHERE m.id <= ?
+                AND (NOT EXISTS (SELECT 1 FROM sessions s WHERE s.id = m.session)
+                OR m.session IN (SELECT id FROM temp.orphan_sessions)
+                OR NOT EXISTS (SELECT 1 FROM users u WHERE u.id = m.sender))
+                ORDER BY m.id
+                """,
+                (scan_max_id,),
+            )
+
+        report = Table(title="Orphans")
+        report.add_column("Table")
+        report.add_column("Orphaned rows", justify="right")
+        report.add_column("Orphaned data", justify="right")
+        report.add_column("Table size", justify="right")
+
+        totals = {}
+        for table in ("messages", "sessions"):
+            count, size = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM temp.orphan_{table}"
+            ).fetchone()
+            totals[table] = count
+            full_size = table_size(conn, table)
+            report.add_row(
+                table,
+                str(count),
+                human_bytes(size),
+                human_bytes(full_size) if full_size is not None else "-",
+            )
+        console.print(report)
+
+        if args.dry_run:
+            console.print("[bold yellow]Dry run: no changes were made[/bold yellow]")
+            exit(0)
+
+        if not any(totals.values()):
+            console.print("[bold green]No orphans found: nothing to do[/bold green]")
+            exit(0)
+
+        with Progress() as progress, profiler.phase("Delete") as phase:
+            task = progress.add_task("Removing orphaned messages", total=totals["messages"])
+            # the temp table is already sorted by id
+            orphans = conn.execute("SELECT id FROM temp.orphan_messages").fetchall()
+            for batch in batched(orphans, args.batch_size):
+                with transaction(conn):
+                    conn.executemany("DELETE FROM messages WHERE id = ?", batch)
+                progress.update(task, advance=len(batch))
+
+            with transaction(conn):
+                conn.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM temp.orphan_sessions)")
+            phase.rows = sum(totals.values())
+
+        if args.vacuum:
+            console.print("[bold green]Vacuuming database...[/bold green]")
+            with profiler.phase("Vacuum"):
+                conn.execute("VACUUM")
+except sqlite3.Error:
+    console.print("[red]Failed to remove orphans due to a database error[/red]")
+    console.print(traceback.format_exc())
+    exit(1)
+
+console.print(
+    f"[bold green]Done! Removed {totals['messages']} messages and {totals['sessions']} sessions[/bold green]"
+)